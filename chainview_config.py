@@ -5,6 +5,11 @@ GITHUB = 'https://github.com/bitcoinedu-io/chainview'
 
 DBFILE = 'chainview-db.sqlite3'
 
+# Pruning (for small deployments): keep full input/output detail only
+# for this many latest blocks, older spent detail is replaced by
+# per-address summaries. 0 = keep everything
+PRUNE_KEEP_BLOCKS = 0
+
 rpc_user = 'user'
 rpc_pass = 'pass'
 NODEURL = 'http://%s:%s@localhost:8332' % (rpc_user, rpc_pass)
@@ -11,7 +11,16 @@ import datetime
 import requests
 import json
 import sqlite3
-from chainview_config import DBFILE, NODEURL
+from chainview_config import DBFILE, NODEURL, PRUNE_KEEP_BLOCKS
+from chainview_maintain import analyze, prune_blocks, bump_changeseq, db_version, LATEST_VERSION
+
+# Run a full ANALYZE when at least this many blocks were fetched in
+# one batch (e.g. initial fill), otherwise only PRAGMA optimize
+ANALYZE_BLOCKS = 1000
+
+# When pruning, prune every this many fetched blocks, so the initial
+# fill never stores much more than PRUNE_KEEP_BLOCKS blocks in full
+PRUNE_EVERY_BLOCKS = 100
 
 # Make RPC call to local node
 
@@ -111,7 +120,10 @@ def fetchblocks(beg, end):
         for i,tx in enumerate(block['tx']):
             cur.execute('INSERT INTO tx (txid, blockhash, n) VALUES (?,?,?)', (tx, hash, i))
             fetchtx(tx)
+        bump_changeseq(cur)
         con.commit()
+        if PRUNE_KEEP_BLOCKS > 0 and bnum % PRUNE_EVERY_BLOCKS == 0:
+            prune_blocks(con, PRUNE_KEEP_BLOCKS)
 
 def fetch_one_batch():
     r = cur.execute('SELECT MAX(height) FROM block')
@@ -140,6 +152,9 @@ def fetch_one_batch():
                 print('Delete and refill database!')
                 assert(False) # automatic rewind: to be implemented
         fetchblocks(beg, end)
+        if PRUNE_KEEP_BLOCKS > 0:
+            prune_blocks(con, PRUNE_KEEP_BLOCKS)
+        analyze(con, full=(end - beg + 1 >= ANALYZE_BLOCKS))
         return True
 
 # Maintain a fresh copy of pending transactions in the db
@@ -161,6 +176,8 @@ def update_pending():
         cur.execute('INSERT INTO tx (txid, blockhash, n) VALUES (?,?,?)', (id,'pending', 0))
         fetchtx(id)
     update_pendingblock(len(pending))
+    if to_delete or to_add:
+        bump_changeseq(cur)
     con.commit()
 
 # Keep dummy block "pending" up to date with current time and current #pendings
@@ -190,6 +207,8 @@ def clear_existing_pending():
     r = cur.execute('SELECT txid FROM tx WHERE blockhash = "pending"')
     existing = set([i[0] for i in r.fetchall()])
     delete_txids(existing)
+    if existing:
+        bump_changeseq(cur)
     con.commit()
 
 # Small helper function, delete all transactions in 'to_delete' from
@@ -204,6 +223,10 @@ def delete_txids(to_delete):
 print('Using database file:', DBFILE)
 con = sqlite3.connect(DBFILE, timeout=30)
 cur = con.cursor()
+ver = db_version(cur)
+if ver != LATEST_VERSION:
+    print('Database version is', ver, 'expected', LATEST_VERSION, '(run migrate)')
+    sys.exit(1)
 
 while True:
     try:
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+#
+# chainview_maintain.py
+#
+# Database maintenance for the chainview sqlite3 database:
+#
+#   chainview_maintain.py migrate        create or upgrade schema to latest version
+#   chainview_maintain.py analyze        update planner statistics (ANALYZE)
+#   chainview_maintain.py vacuum         give free pages back to the OS, in small steps
+#   chainview_maintain.py check          integrity check and block/tx/input/output cross-check
+#   chainview_maintain.py prune [KEEP]   drop spent input/output detail older than KEEP blocks
+#
+# All commands except "migrate" (which may do one full VACUUM) can be
+# run while chainview_fill.py and the web server are running.
+
+import sys
+import time
+import argparse
+import sqlite3
+from chainview_config import DBFILE, PRUNE_KEEP_BLOCKS
+
+# Schema migrations, applied in order. Each step takes the database
+# from one version to the next and sets the new version number.
+# Note: one dummy "pending" block is special, see chainview_fill.py
+
+MIGRATIONS = [
+    ('0.0', '1.0', """
+CREATE TABLE version (ver TEXT);
+
+CREATE TABLE block (
+    hash TEXT PRIMARY KEY,      -- 'pending' means dummy pending block
+    height INTEGER UNIQUE,      -- '-1' means dummy pending block
+    previousblockhash TEXT UNIQUE,
+    strippedsize INTEGER,
+    size INTEGER,
+    weight INTEGER,
+    versionhex INTEGER,
+    merkleroot TEXT,
+    time TEXT,
+    mediantime TEXT,
+    nonce INTEGER,
+    bits TEXT,
+    difficulty TEXT,
+    chainwork TEXT,
+    numtxs INTEGER
+);
+
+CREATE TABLE tx (
+    txid TEXT PRIMARY KEY,
+    blockhash TEXT,       -- 'pending' means in mempool only
+    n INTEGER
+);
+
+CREATE TABLE input (
+    txid TEXT,
+    n INTEGER,
+    spendstxid TEXT,
+    spendsn INTEGER
+);
+
+CREATE TABLE output (
+    txid TEXT,
+    n INTEGER,
+    type TEXT,       -- '' = normal, 'c' = nulltype/coinbase, 'u' = unknown
+    value INTEGER,   -- satoshis
+    address TEXT
+);
+
+CREATE INDEX idx_input_txid ON input(txid);
+CREATE INDEX idx_input_spendstxid ON input(spendstxid);
+CREATE INDEX idx_output_txid ON output(txid);
+CREATE INDEX idx_output_address ON output(address);
+
+INSERT INTO version VALUES ('1.0');
+    """),
+    ('1.0', '1.1', """
+CREATE TABLE pruned (
+    height INTEGER   -- input/output detail only kept for blocks >= height
+);
+
+CREATE TABLE address_summary (
+    address TEXT PRIMARY KEY,
+    numoutputs INTEGER,   -- pruned (received and spent) outputs
+    received INTEGER,     -- sum of pruned outputs, all of it spent
+    firsttime INTEGER,    -- time of block of first pruned output
+    lasttime INTEGER      -- time of block of last pruned spend
+);
+
+CREATE INDEX idx_tx_blockhash ON tx(blockhash);
+
+INSERT INTO pruned VALUES (0);
+UPDATE version SET ver = '1.1';
+    """),
+    ('1.1', '1.2', """
+CREATE TABLE changeseq (
+    seq INTEGER   -- bumped by every commit that changes blocks or mempool
+);
+
+INSERT INTO changeseq VALUES (0);
+UPDATE version SET ver = '1.2';
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][1]
+
+# Read schema version, '0.0' means empty database
+
+def db_version(cur):
+    exists = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='version'")
+    if len(exists.fetchall()) == 0:
+        return '0.0'
+    return cur.execute('SELECT ver FROM version').fetchone()[0]
+
+# Tell web servers that blocks or mempool have changed, call before
+# commit (see HotTip in chainview_webserver.py)
+
+def bump_changeseq(cur):
+    cur.execute('UPDATE changeseq SET seq = seq + 1')
+
+# Apply all migrations needed to reach LATEST_VERSION, each in its own
+# transaction so an interrupted step leaves the previous version. Also switches
+# the database to incremental auto vacuum (needs one full VACUUM,
+# which blocks other processes while running) and WAL journal mode
+# (readers are not blocked by the fill process or by maintenance)
+
+def migrate(con):
+    cur = con.cursor()
+    ver = db_version(cur)
+    print('Database version:', ver)
+    for fromver, tover, script in MIGRATIONS:
+        if ver == fromver:
+            print('Updating database to v%s...' % tover)
+            try:
+                cur.executescript('BEGIN;' + script + 'COMMIT;')
+            except sqlite3.Error as e:
+                con.rollback()
+                print('Update failed, database left at v%s:' % ver, e)
+                return False
+            ver = tover
+            print('Updated database to v%s!' % ver)
+    if ver != LATEST_VERSION:
+        print('Unknown database version, cannot migrate:', ver)
+        return False
+    if cur.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print('Enabling incremental vacuum (full VACUUM, may take a while)...')
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cur.execute('VACUUM')
+    if cur.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+        cur.execute('PRAGMA journal_mode = WAL')
+    print('Database is at latest version', LATEST_VERSION)
+    return True
+
+# Update query planner statistics. A full ANALYZE after bulk loads
+# (e.g. first fill), otherwise PRAGMA optimize which only re-analyzes
+# tables whose statistics are likely out of date
+
+def analyze(con, full=True):
+    if full:
+        con.execute('ANALYZE')
+    else:
+        con.execute('PRAGMA optimize')
+    con.commit()
+
+# Give free pages back to the file system, 'pages' pages at a time
+# with a short pause in between, so the write lock is only held
+# briefly and fill/web processes can keep running
+
+def incremental_vacuum(con, pages=1000, pause=0.1):
+    cur = con.cursor()
+    if cur.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print('Incremental vacuum not enabled, run: chainview_maintain.py migrate')
+        return 0
+    start = cur.execute('PRAGMA freelist_count').fetchone()[0]
+    free = start
+    while free > 0:
+        # executescript steps the pragma to completion, execute only
+        # frees one page per call
+        cur.executescript('PRAGMA incremental_vacuum(%d);' % pages)
+        left = cur.execute('PRAGMA freelist_count').fetchone()[0]
+        if left >= free:
+            break   # no progress, e.g. locked
+        free = left
+        time.sleep(pause)
+    total = start - free
+    print('Freed', total, 'pages')
+    # file only shrinks when WAL is written back, busy if readers are active
+    for i in range(10):
+        busy = cur.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[0]
+        if not busy:
+            break
+        time.sleep(1)
+    if busy:
+        print('WAL checkpoint busy, file shrinks at a later checkpoint')
+    return total
+
+# Run sqlite integrity check and cross-check block, tx, input and
+# output tables against each other. Prints problems found and
+# returns number of failed checks.
+
+CROSS_CHECKS = [
+    ('block heights not contiguous',
+     '''SELECT COUNT(*) - (MAX(height) + 1) FROM block WHERE height >= 0'''),
+    # dummy pending block is left out, its numtxs is only updated by
+    # update_pending in chainview_fill.py, not while fetching blocks
+    ('blocks with numtxs different from number of txs',
+     '''SELECT COUNT(*) FROM
+        (SELECT block.numtxs AS numtxs, COUNT(tx.txid) AS cnt FROM block
+                LEFT JOIN tx ON tx.blockhash = block.hash
+                WHERE block.height >= 0
+                GROUP BY block.hash)
+        WHERE numtxs != cnt'''),
+    ('txs in unknown block',
+     '''SELECT COUNT(*) FROM tx
+        WHERE NOT EXISTS (SELECT 1 FROM block WHERE block.hash = tx.blockhash)'''),
+    ('inputs of unknown tx',
+     '''SELECT COUNT(*) FROM input
+        WHERE NOT EXISTS (SELECT 1 FROM tx WHERE tx.txid = input.txid)'''),
+    ('outputs of unknown tx',
+     '''SELECT COUNT(*) FROM output
+        WHERE NOT EXISTS (SELECT 1 FROM tx WHERE tx.txid = output.txid)'''),
+    ('duplicate outputs',
+     '''SELECT COUNT(*) FROM
+        (SELECT 1 FROM output GROUP BY txid, n HAVING COUNT(*) > 1)'''),
+    ('inputs spending unknown output',
+     '''SELECT COUNT(*) FROM input
+        WHERE NOT EXISTS (SELECT 1 FROM output
+                          WHERE output.txid = input.spendstxid AND output.n = input.spendsn)'''),
+    ('unpruned txs without outputs',
+     '''SELECT COUNT(*) FROM tx JOIN block ON tx.blockhash = block.hash
+        WHERE (block.height >= (SELECT height FROM pruned) OR block.height = -1)
+          AND NOT EXISTS (SELECT 1 FROM output WHERE output.txid = tx.txid)'''),
+    ('unpruned non-coinbase txs without inputs',
+     '''SELECT COUNT(*) FROM tx JOIN block ON tx.blockhash = block.hash
+        WHERE (block.height >= (SELECT height FROM pruned) OR block.height = -1)
+          AND (tx.n > 0 OR block.height = -1)
+          AND NOT EXISTS (SELECT 1 FROM input WHERE input.txid = tx.txid)'''),
+]
+
+def check(con, full=False):
+    cur = con.cursor()
+    problems = 0
+    ver = db_version(cur)
+    if ver != LATEST_VERSION:
+        print('Database version is', ver, 'expected', LATEST_VERSION, '(run migrate)')
+        return 1
+    pragma = 'integrity_check' if full else 'quick_check'
+    res = [r[0] for r in cur.execute('PRAGMA %s' % pragma).fetchall()]
+    if res != ['ok']:
+        problems += 1
+        print('PRAGMA %s failed:' % pragma)
+        for r in res:
+            print('  ', r)
+    for name, sql in CROSS_CHECKS:
+        cnt = cur.execute(sql).fetchone()[0]
+        if cnt:
+            problems += 1
+            print('Failed: %s (%s)' % (name, cnt))
+        else:
+            print('Ok:', name)
+    for table in ['block', 'tx', 'input', 'output', 'address_summary']:
+        cnt = cur.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+        print('Rows in %s: %d' % (table, cnt))
+    print('Problems found:', problems)
+    return problems
+
+# Prune input/output detail for all blocks below dbmax - keep + 1, in
+# steps of 'step' blocks per transaction. Only inputs and the outputs
+# they spend are removed, both in pruned blocks. Unspent outputs and
+# outputs spent in later blocks are kept, so balances and the
+# remaining blocks show correctly. Removed outputs are added to
+# address_summary. Returns new prune height.
+
+def prune_blocks(con, keep, step=100):
+    cur = con.cursor()
+    dbmax = cur.execute('SELECT MAX(height) FROM block').fetchone()[0]
+    if dbmax is None:
+        return 0
+    target = max(dbmax - keep + 1, 0)
+    height = cur.execute('SELECT height FROM pruned').fetchone()[0]
+    while height < target:
+        end = min(height + step, target)
+        # spends in blocks [height, end) and the outputs they spend
+        spends = '''
+            FROM input JOIN tx ON input.txid = tx.txid
+                       JOIN block ON tx.blockhash = block.hash
+                       JOIN output ON input.spendstxid = output.txid AND input.spendsn = output.n
+                       JOIN tx AS otx ON output.txid = otx.txid
+                       JOIN block AS oblock ON otx.blockhash = oblock.hash
+            WHERE block.height >= ? AND block.height < ?'''
+        cur.execute('''
+            INSERT INTO address_summary (address, numoutputs, received, firsttime, lasttime)
+            SELECT output.address, COUNT(*), SUM(output.value),
+                   MIN(CAST(oblock.time AS INTEGER)), MAX(CAST(block.time AS INTEGER))
+            ''' + spends + '''
+            GROUP BY output.address
+            ON CONFLICT(address) DO UPDATE SET
+                numoutputs = numoutputs + excluded.numoutputs,
+                received = received + excluded.received,
+                firsttime = MIN(firsttime, excluded.firsttime),
+                lasttime = MAX(lasttime, excluded.lasttime)''', (height, end))
+        cur.execute('DELETE FROM output WHERE rowid IN (SELECT output.rowid' + spends + ')',
+                    (height, end))
+        cur.execute('''
+            DELETE FROM input WHERE txid IN
+                (SELECT tx.txid FROM tx JOIN block ON tx.blockhash = block.hash
+                 WHERE block.height >= ? AND block.height < ?)''', (height, end))
+        cur.execute('UPDATE pruned SET height = ?', (end,))
+        bump_changeseq(cur)
+        con.commit()
+        height = end
+    return height
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain chainview database')
+    parser.add_argument('--db', default=DBFILE, help='database file (default: %(default)s)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('migrate', help='create or upgrade database schema')
+    sub.add_parser('analyze', help='update query planner statistics')
+    p = sub.add_parser('vacuum', help='incremental vacuum, safe while running')
+    p.add_argument('--pages', type=int, default=1000, help='pages per step')
+    p.add_argument('--full', action='store_true', help='full VACUUM, blocks other processes')
+    p = sub.add_parser('check', help='integrity and consistency check')
+    p.add_argument('--full', action='store_true', help='integrity_check instead of quick_check')
+    p = sub.add_parser('prune', help='drop spent input/output detail of old blocks')
+    p.add_argument('keep', type=int, nargs='?', default=PRUNE_KEEP_BLOCKS,
+                   help='number of latest blocks to keep in full (default: %(default)s)')
+    args = parser.parse_args()
+
+    print('Using database file:', args.db)
+    con = sqlite3.connect(args.db, timeout=30)
+    if args.command == 'migrate':
+        return 0 if migrate(con) else 1
+    ver = db_version(con.cursor())
+    if ver != LATEST_VERSION:
+        print('Database version is', ver, 'expected', LATEST_VERSION, '(run migrate)')
+        return 1
+    if args.command == 'analyze':
+        analyze(con)
+        print('Analyzed')
+    elif args.command == 'vacuum':
+        if args.full:
+            con.execute('VACUUM')
+            print('Vacuumed')
+        else:
+            incremental_vacuum(con, args.pages)
+    elif args.command == 'check':
+        return 1 if check(con, args.full) else 0
+    elif args.command == 'prune':
+        if args.keep <= 0:
+            print('Number of blocks to keep must be > 0')
+            return 1
+        height = prune_blocks(con, args.keep)
+        print('Input/output detail pruned below height', height)
+        analyze(con, full=False)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
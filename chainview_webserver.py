@@ -9,6 +9,9 @@ import requests, json
 import datetime, time
 import decimal, math
 import sqlite3
+import threading
+from array import array
+from collections import deque
 from flask import Flask, url_for, abort, request, redirect
 from flask import render_template
 from chainview_config import VERSION, GITHUB, DBFILE, chaininfo, params
@@ -55,14 +58,20 @@ def latest_topinfo(cur):
     else:
         r = cur.execute('SELECT time FROM block WHERE height = ?', (dbmax,))
         timestamp = r.fetchone()[0]
+    r = cur.execute('SELECT COUNT(*) FROM tx WHERE blockhash="pending"')
+    pending = int(r.fetchone()[0])
+    return make_topinfo(dbmax, timestamp, pending)
+
+# Info to display on top, from latest block number, its time and
+# number of pending txs
+
+def make_topinfo(dbmax, timestamp, pending):
     now = datetime.datetime.now().replace(microsecond=0)
     timelast = datetime.datetime.fromtimestamp(int(timestamp))
     age = ageof(timelast, now)
     is_dst = time.daylight and time.localtime().tm_isdst > 0
     tzname = time.tzname[is_dst]
     nowstr = now.strftime('%a') + ' ' + str(now) + ' ' + tzname
-    r = cur.execute('SELECT COUNT(*) FROM tx WHERE blockhash="pending"')
-    pending = int(r.fetchone()[0])
     return {'dbmax': dbmax, 'time': timelast, 'age': age, 'now': now, 'nowstr': nowstr,
             'pending': pending,
             'version': VERSION, 'github': GITHUB}
@@ -77,9 +86,18 @@ BLOCKS_PER_PAGE = 500
 @app.route("/")
 @app.route("/blocks/")
 def main_page(startblock=None):
-    con = sqlite3.connect(DBFILE)
-    cur = con.cursor()
-    topinfo = latest_topinfo(cur)
+    # extra option to only show blocks with #txs > txlimit (to get rid of empty blocks)
+    # (todo: next/prev doesn't really work properly when using txlimit)
+    txlimit = int(request.args.get('txlimit','0'))
+
+    # latest blocks are served from memory
+    hot = startblock == None and txlimit == 0 and hottip.latest_blocks()
+    if hot:
+        topinfo, rows = hot
+    else:
+        con = sqlite3.connect(DBFILE)
+        cur = con.cursor()
+        topinfo = latest_topinfo(cur)
     dbmax = topinfo['dbmax']
     now = topinfo['now']
 
@@ -94,16 +112,14 @@ def main_page(startblock=None):
     prevurl = url_for('main_page', startblock=prevpage) if prevpage < high else ''
     nexturl = url_for('main_page', startblock=nextpage) if nextpage > high else ''
 
-    # extra option to only show blocks with #txs > txlimit (to get rid of empty blocks)
-    # (todo: next/prev doesn't really work properly when using txlimit)
-    txlimit = int(request.args.get('txlimit','0'))
-    
-    r = cur.execute('''
-        SELECT height, time, numtxs FROM block
-        WHERE height <= ? AND height >= 0 AND numtxs >= ?
-        ORDER BY height DESC LIMIT ?''', (str(high),txlimit,BLOCKS_PER_PAGE))
+    if not hot:
+        r = cur.execute('''
+            SELECT height, time, numtxs FROM block
+            WHERE height <= ? AND height >= 0 AND numtxs >= ?
+            ORDER BY height DESC LIMIT ?''', (str(high),txlimit,BLOCKS_PER_PAGE))
+        rows = r.fetchall()
     blocks = []
-    for r in r.fetchall():
+    for r in rows:
         time = datetime.datetime.fromtimestamp(int(r[1]))
         b = {'height': r[0], 'time': time, 'age': ageof(time,now), 'numtxs': r[2]}
         blocks.append(b)
@@ -120,23 +136,25 @@ def main_page(startblock=None):
 # For each transaction in txs, fetch inputs and outputs
 # For an input, fetch corresponding spent output address and value
 # For an output, also find txid if spent in later transaction
-# Note: adds data to existing txs elements
+# Note: adds data to existing txs elements, 'spends' (spent txid, n)
+# is only used by HotTip
 
 def get_inputs_outputs(txs, cur):
     for tx in txs:
         txid = tx['txid']
-        resI = cur.execute('SELECT output.address, output.value FROM input INNER JOIN output ON input.spendstxid=output.txid AND input.spendsn=output.n WHERE input.txid = ? ORDER BY input.n',
+        resI = cur.execute('SELECT output.address, output.value, input.spendstxid, input.spendsn FROM input INNER JOIN output ON input.spendstxid=output.txid AND input.spendsn=output.n WHERE input.txid = ? ORDER BY input.n',
                            (txid,))
         inputs = resI.fetchall()
+        tx['spends'] = [(i[2], i[3]) for i in inputs]
         if len(inputs) == 0:
             tx['inputs'] = [('Coinbase', 'mining reward')]
         else:
             tx['inputs'] = [(i[0], num2str(i[1])) for i in inputs]
         resO = cur.execute(
-            '''SELECT output.address,output.value,output.type,input.txid FROM output
+            '''SELECT output.address,output.value,output.type,input.txid,output.n FROM output
                LEFT JOIN input ON input.spendstxid=output.txid AND input.spendsn=output.n
                WHERE output.txid=? ORDER BY output.n''', (txid,))
-        tx['outputs'] = [{'address':r[0], 'value':num2str(r[1]), 'type':r[2], 'spentby':r[3]}
+        tx['outputs'] = [{'address':r[0], 'value':num2str(r[1]), 'type':r[2], 'spentby':r[3], 'n':r[4]}
                          for r in resO.fetchall()]
         if tx['inputs'][0][0] != 'Coinbase':
             fee = decimal.Decimal('0.0')
@@ -147,17 +165,301 @@ def get_inputs_outputs(txs, cur):
             tx['fee'] = num2str(fee)
     return
 
+# Blocks below the returned height have had their spent input/output
+# detail pruned (see chainview_maintain.py)
+
+def pruned_height(cur):
+    return cur.execute('SELECT height FROM pruned').fetchone()[0]
+
+# Helper for block_page and address_page, after get_inputs_outputs
+# Txs in pruned blocks have lost their inputs and would show as
+# coinbase, mark them as pruned instead. txs need 'height' and 'pos'
+# (position in block, 0 = coinbase). Returns True if any tx is in a
+# pruned block
+
+def mark_pruned(txs, cur):
+    pruned = pruned_height(cur)
+    found = False
+    for tx in txs:
+        if 0 <= tx['height'] < pruned:
+            found = True
+            if tx['pos'] > 0:
+                tx['inputs'] = [('Pruned', '')]
+                tx.pop('fee', None)
+    return found
+
+############## in-memory index of chain tip, one per web worker
+# Holds headers of the latest BLOCKS_PER_PAGE blocks (for main page),
+# txs of the latest HOT_BLOCKS blocks and the mempool (for block and
+# pending pages). Refreshed incrementally when chainview_fill.py has
+# bumped the change sequence number, checked at most every
+# HOT_CHECK_INTERVAL sec. Blocks or mempool with more than HOT_MAX_TXS
+# txs are not kept, those pages are read from the database as before.
+# While one thread loads, the other threads read from the database.
+
+HOT_BLOCKS = 10
+HOT_MAX_TXS = 5000
+HOT_CHECK_INTERVAL = 2
+HOT_LOCK_WAIT = 0.1
+
+# Records can be used like the dicts from get_inputs_outputs in templates
+
+class OutputRecord:
+    __slots__ = ('n', 'address', 'value', 'type', 'spentby')
+
+    def __init__(self, op):
+        self.n = op['n']
+        self.address = op['address']
+        self.value = op['value']
+        self.type = op['type']
+        self.spentby = op['spentby']
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+class TxRecord:
+    __slots__ = ('txid', 'n', 'inputs', 'spends', 'outputs', 'fee')
+
+    def __init__(self, tx):
+        self.txid = tx['txid']
+        self.n = tx['n']
+        self.inputs = tuple(tx['inputs'])
+        self.spends = tuple(tx['spends'])
+        self.outputs = tuple(OutputRecord(op) for op in tx['outputs'])
+        self.fee = tx.get('fee')
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+# row is (height, hash, previousblockhash, merkleroot, time, difficulty, numtxs)
+# txs is None if block has too many txs to keep
+
+class BlockRecord:
+    __slots__ = ('row', 'txs')
+
+    def __init__(self, row, txs):
+        self.row = row
+        self.txs = txs
+
+class HotTip:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loading = False
+        self.checked = None
+        self.seq = None
+        self.clear()
+
+    def clear(self):
+        self.top = -1             # latest block height
+        self.tiphash = None
+        self.pruned = 0
+        self.times = array('q')   # headers of blocks top-len+1 .. top
+        self.numtxs = array('l')
+        self.blocks = deque()     # BlockRecords of latest HOT_BLOCKS blocks
+        self.pending = None       # TxRecords in mempool, None if not kept
+        self.pendingspends = []   # (txid, spent txid, n) in mempool spending kept outputs, if not kept
+        self.numpending = 0
+        self.txindex = {}         # txid -> TxRecord, for all kept txs
+
+    # Run fn with up to date content, under lock. Returns None if
+    # content is not available (being loaded by another thread or
+    # database error), then the caller reads from the database
+
+    def snapshot(self, fn):
+        self.refresh()
+        if self.loading or not self.lock.acquire(timeout=HOT_LOCK_WAIT):
+            return None
+        try:
+            if self.seq == None:
+                return None
+            return fn()
+        finally:
+            self.lock.release()
+
+    # Reload from database if change sequence number has changed. Only
+    # one thread loads, others skip
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.checked != None and now - self.checked < HOT_CHECK_INTERVAL:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        self.loading = True
+        try:
+            self.checked = now
+            con = sqlite3.connect(DBFILE)
+            try:
+                cur = con.cursor()
+                cur.execute('BEGIN')   # read seq and data from same snapshot
+                seq = cur.execute('SELECT seq FROM changeseq').fetchone()[0]
+                if seq != self.seq:
+                    self.load(cur)
+                    self.seq = seq
+            finally:
+                con.close()
+        except sqlite3.Error as e:
+            print('HotTip: cannot load from database:', e)
+            self.clear()   # maybe half loaded, reload all next time
+            self.seq = None
+        finally:
+            self.loading = False
+            self.lock.release()
+
+    def load(self, cur):
+        dbmax = cur.execute('SELECT MAX(height) FROM block').fetchone()[0]
+        if dbmax == None:
+            dbmax = -1
+        if self.tiphash != None:
+            r = cur.execute('SELECT hash FROM block WHERE height = ?', (self.top,)).fetchone()
+            if dbmax < self.top or not r or r[0] != self.tiphash:
+                self.clear()   # database rebuilt, start over
+        self.pruned = pruned_height(cur)
+
+        # drop txs no longer in mempool
+        res = cur.execute('SELECT txid,n FROM tx WHERE blockhash = ? ORDER BY n', ('pending',))
+        pendingrows = res.fetchall()
+        self.numpending = len(pendingrows)
+        pendingids = set(r[0] for r in pendingrows)
+        if self.pending != None:
+            for tx in self.pending:
+                if tx.txid not in pendingids:
+                    self.unlink(tx)
+            self.pending = [tx for tx in self.pending if tx.txid in pendingids]
+        for txid, spenttxid, n in self.pendingspends:
+            self.mark_spent(spenttxid, n, txid, None)
+        self.pendingspends = []
+
+        # add new blocks, drop old ones
+        first = max(self.top + 1, dbmax - BLOCKS_PER_PAGE + 1, 0)
+        res = cur.execute('''SELECT height, hash, previousblockhash, merkleroot, time, difficulty, numtxs
+                             FROM block WHERE height >= ? ORDER BY height''', (first,))
+        for r in res.fetchall():
+            self.times.append(int(r[4]))
+            self.numtxs.append(r[6])
+            if r[0] > dbmax - HOT_BLOCKS:
+                txs = None
+                if r[6] <= HOT_MAX_TXS:
+                    restx = cur.execute('SELECT txid,n FROM tx WHERE blockhash = ? ORDER BY n', (r[1],))
+                    txs = self.load_txs([{'txid':t[0], 'n':t[1]} for t in restx.fetchall()], cur)
+                else:
+                    # not kept, but outputs it spends may be
+                    for spend in self.block_spends(r[1], cur):
+                        self.mark_spent(spend[1], spend[2], spend[0], spend[0])
+                self.blocks.append(BlockRecord(r, txs))
+            self.top = r[0]
+            self.tiphash = r[1]
+        excess = len(self.times) - BLOCKS_PER_PAGE
+        if excess > 0:
+            del self.times[:excess]
+            del self.numtxs[:excess]
+        while self.blocks and self.blocks[0].row[0] <= self.top - HOT_BLOCKS:
+            b = self.blocks.popleft()
+            for tx in b.txs or []:
+                self.unlink(tx)
+
+        # add new txs in mempool
+        if self.numpending > HOT_MAX_TXS:
+            for tx in self.pending or []:
+                self.unlink(tx)
+            self.pending = None
+            # not kept, remember spends to undo them at next load
+            self.pendingspends = self.block_spends('pending', cur)
+            for txid, spenttxid, n in self.pendingspends:
+                self.mark_spent(spenttxid, n, txid, txid)
+        else:
+            if self.pending == None:
+                self.pending = []
+            known = set(tx.txid for tx in self.pending)
+            new = [{'txid':r[0], 'n':r[1]} for r in pendingrows if r[0] not in known]
+            self.pending.extend(self.load_txs(new, cur))
+
+    # (txid, spent txid, n) for inputs of txs in block blockhash that
+    # spend kept outputs. Rows are filtered while read, so memory is
+    # bounded by kept txs, not by size of block or mempool
+
+    def block_spends(self, blockhash, cur):
+        res = cur.execute('''SELECT txid, spendstxid, spendsn FROM input
+                             WHERE txid IN (SELECT txid FROM tx WHERE blockhash = ?)''', (blockhash,))
+        return [r for r in res if r[1] in self.txindex]
+
+    def load_txs(self, txs, cur):
+        get_inputs_outputs(txs, cur)
+        recs = [TxRecord(tx) for tx in txs]
+        for rec in recs:
+            self.txindex[rec.txid] = rec
+            for txid, n in rec.spends:
+                self.mark_spent(txid, n, rec.txid, rec.txid)
+        return recs
+
+    def unlink(self, rec):
+        self.txindex.pop(rec.txid, None)
+        for txid, n in rec.spends:
+            self.mark_spent(txid, n, rec.txid, None)
+
+    # Set spentby of kept output (txid, n) spent by spender, or clear
+    # it if spentby is None (and it still is spender)
+
+    def mark_spent(self, txid, n, spender, spentby):
+        spent = self.txindex.get(txid)
+        if spent:
+            for op in spent.outputs:
+                if op.n == n and (spentby or op.spentby == spender):
+                    op.spentby = spentby
+
+    def topinfo(self):
+        timestamp = self.times[-1] if self.times else 0
+        return make_topinfo(self.top, timestamp, self.numpending)
+
+    # (topinfo, rows) where rows are (height, time, numtxs) of latest
+    # blocks, highest first. None if not available
+
+    def latest_blocks(self):
+        def fn():
+            low = self.top - len(self.times) + 1
+            rows = [(low + i, self.times[i], self.numtxs[i])
+                    for i in range(len(self.times) - 1, -1, -1)]
+            return self.topinfo(), rows
+        return self.snapshot(fn)
+
+    # (topinfo, row, txs) for block with height blocknr, None if not kept
+
+    def block(self, blocknr):
+        def fn():
+            if blocknr < self.pruned:
+                return None
+            for b in self.blocks:
+                if b.row[0] == blocknr and b.txs != None:
+                    return self.topinfo(), b.row, list(b.txs)
+            return None
+        return self.snapshot(fn)
+
+    # (topinfo, txs) for mempool, None if not kept
+
+    def pending_txs(self):
+        def fn():
+            if self.pending == None:
+                return None
+            return self.topinfo(), list(self.pending)
+        return self.snapshot(fn)
+
+hottip = HotTip()
+
 @app.route("/block/<int:blocknr>")
 def block_page(blocknr):
-    con = sqlite3.connect(DBFILE)
-    cur = con.cursor()
-    topinfo = latest_topinfo(cur)
+    hot = hottip.block(blocknr)
+    if hot:
+        topinfo, r, txs = hot
+    else:
+        con = sqlite3.connect(DBFILE)
+        cur = con.cursor()
+        topinfo = latest_topinfo(cur)
+        r = cur.execute('''SELECT height, hash, previousblockhash, merkleroot, time, difficulty, numtxs
+                              FROM block WHERE height = ?''',
+                        (blocknr,))
+        r = r.fetchone()
     now = topinfo['now']
-    
-    r = cur.execute('''SELECT height, hash, previousblockhash, merkleroot, time, difficulty, numtxs
-                          FROM block WHERE height = ?''',
-                    (blocknr,))
-    r = r.fetchone()
+
     if r:
         timestamp = int(r[4])
         time = datetime.datetime.fromtimestamp(timestamp)
@@ -173,10 +475,14 @@ def block_page(blocknr):
         prevurl = url_for('block_page', blocknr=prevb) if prevb < blocknr else ''
         nexturl = url_for('block_page', blocknr=nextb) if nextb > blocknr else ''
         info = {'prevurl': prevurl, 'nexturl': nexturl}
-        res = cur.execute('SELECT txid,n FROM tx WHERE blockhash = ? ORDER BY n', (block['hash'],))
-        txs = [{'txid':r[0], 'n':r[1]} for r in res.fetchall()]
         txinfo = {'page':'block', 'header':''}
-        get_inputs_outputs(txs, cur)
+        if not hot:
+            res = cur.execute('SELECT txid,n FROM tx WHERE blockhash = ? ORDER BY n', (block['hash'],))
+            txs = [{'txid':r[0], 'n':r[1], 'height':blocknr, 'pos':r[1]} for r in res.fetchall()]
+            get_inputs_outputs(txs, cur)
+            if mark_pruned(txs, cur):
+                # inputs are gone, only unspent (or later spent) outputs remain
+                txinfo['header'] = ', spent inputs/outputs pruned'
         pagetitle = 'Block #%d' % blocknr
         return render_template('block-page.html', pagetitle=pagetitle, chaininfo=chaininfo, topinfo=topinfo, info=info,
                                block=block, txinfo=txinfo, txs=txs)
@@ -187,15 +493,17 @@ def block_page(blocknr):
 
 @app.route("/block/pending")
 def block_pending():
-    con = sqlite3.connect(DBFILE)
-    cur = con.cursor()
-    topinfo = latest_topinfo(cur)
-    now = topinfo['now']
-    
-    res = cur.execute('SELECT txid,n FROM tx WHERE blockhash = ? ORDER BY n', ('pending',))
-    txs = [{'txid':r[0], 'n':r[1]} for r in res.fetchall()]
+    hot = hottip.pending_txs()
+    if hot:
+        topinfo, txs = hot
+    else:
+        con = sqlite3.connect(DBFILE)
+        cur = con.cursor()
+        topinfo = latest_topinfo(cur)
+        res = cur.execute('SELECT txid,n FROM tx WHERE blockhash = ? ORDER BY n', ('pending',))
+        txs = [{'txid':r[0], 'n':r[1]} for r in res.fetchall()]
+        get_inputs_outputs(txs, cur)
     txinfo = {'page':'block', 'header':''}
-    get_inputs_outputs(txs, cur)
     pagetitle = 'Pending'
     return render_template('block-pending.html', pagetitle=pagetitle, chaininfo=chaininfo, topinfo=topinfo,
                            txinfo=txinfo, txs=txs)
@@ -209,7 +517,7 @@ def address_page(address):
 
     # Search for address in both outputs and inputs
     res = cur.execute('''
-       SELECT txid,block.height,block.time FROM
+       SELECT txid,block.height,block.time,tx.n FROM
        (SELECT output.txid as id FROM output
                WHERE output.address=?
        UNION
@@ -221,13 +529,19 @@ def address_page(address):
        ORDER BY block.height DESC, tx.n DESC
     ''', (address, address))
 
-    txs = [{'txid':r[0], 'n':-1, 'height':r[1], 'time':datetime.datetime.fromtimestamp(int(r[2]))}
+    txs = [{'txid':r[0], 'n':-1, 'height':r[1], 'time':datetime.datetime.fromtimestamp(int(r[2])),
+            'pos':r[3]}
            for r in res.fetchall()]
-    if len(txs) == 0:
+    # summary of pruned history, if any
+    res = cur.execute('SELECT numoutputs, received, firsttime, lasttime FROM address_summary WHERE address=?',
+                      (address,))
+    summary = res.fetchone()
+    if len(txs) == 0 and not summary:
         pagetitle = 'Address not found'
         return render_template('searchfail-page.html', pagetitle=pagetitle, chaininfo=chaininfo, topinfo=topinfo, search=address, err='Cannot find address (no transactions found)!')
 
     get_inputs_outputs(txs, cur)
+    mark_pruned(txs, cur)
     
     balance = decimal.Decimal('0.0')
     for tx in txs:
@@ -248,18 +562,28 @@ def address_page(address):
 
     if len(pendingtxs) > 0:
         lastuse = pendingtxs[0]['time']
-    else:
+    elif len(txs) > 0:
         lastuse  = txs[0]['time']
+    else:
+        lastuse = datetime.datetime.fromtimestamp(summary[3])
+    if summary and len(pendingtxs) == 0:
+        # pruned spends can be later than kept txs
+        lastuse = max(lastuse, datetime.datetime.fromtimestamp(summary[3]))
     if len(txs) > 0:
         firstuse = txs[-1]['time']
     else:
         firstuse = lastuse
+    if summary:
+        # kept outputs in pruned blocks can be older than pruned spends
+        firstuse = min(firstuse, datetime.datetime.fromtimestamp(summary[2]))
     agefirst = ageof(firstuse, now)
     agelast = ageof(lastuse, now)
     addr = {'addr':address, 'balance':num2str(balance),
             'firstuse':firstuse, 'agefirst':agefirst,
             'lastuse':lastuse, 'agelast':agelast,
             'notxs':len(txs)+len(pendingtxs)}
+    if summary:
+        addr['pruned'] = {'numoutputs':summary[0], 'received':num2str(summary[1])}
     txinfo = {'page':'address', 'header':', recent first'}
     
     # extra option to remove coinbase-txs
@@ -370,7 +694,8 @@ def search():
             err = 'Cannot find block, merkle, or transaction hash.'
 
     # Otherwise, check if address
-    res = cur.execute('SELECT COUNT(*) FROM output WHERE address=?', (s,))
+    res = cur.execute('''SELECT (SELECT COUNT(*) FROM output WHERE address=?) +
+                                (SELECT COUNT(*) FROM address_summary WHERE address=?)''', (s,s))
     if int(res.fetchone()[0]) > 0:
         return redirect(url_for('address_page', address=s))
     